@@ -19,37 +19,115 @@
 # the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
 # Boston, MA 02110-1301, USA.
 
-# This file should work with Python 2.7 and 3.4+
-
-from __future__ import print_function, unicode_literals
+# This file should work with Python 3.5+
 
 import argparse
-from io import open
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import hashlib
+import importlib
+import multiprocessing
 import os
+import re
+import shutil
 import subprocess
 import sys
+import tempfile
+from xml.sax.saxutils import escape, quoteattr
 
 from languages import TRANSLATIONS, LANGUAGE_CODES as LANGUAGES
 
 DOC_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# Files in the source directory that affect the output of a Sphinx build
+SOURCE_SUFFIXES = ('.rst', '.py', '.po', '.html', '.css', '.js', '.png',
+                   '.gif', '.jpg', '.jpeg', '.svg')
+
+# Python packages whose version affects the output of a Sphinx build
+SPHINX_PACKAGES = ['sphinx', 'docutils', 'sphinxcontrib.qthelp',
+                   'quark_sphinx_theme', 'sphinx_bootstrap_theme']
+
+# Outputs of a Sphinx build, by builder, that later steps rely on. A build is
+# redone if any of them is missing.
+BUILDER_OUTPUT_SUFFIXES = {
+    'gettext': ('.pot',),
+    'qthelp2': ('.qhp', '.qhcp'),
+}
+
 
 class Tools:
     TOOLS = ['sphinx-build', 'sphinx-intl', 'qcollectiongenerator']
 
     def __init__(self, args):
+        self._binaries = {}
         self._tools = {}
         for tool in self.TOOLS:
             safename = tool.replace('-', '_')
-            self._tools[safename] = getattr(args, '%s_binary' % safename)
+            self._binaries[safename] = getattr(args, '%s_binary' % safename)
+            self._tools[safename] = functools.partial(self.run_tool, safename)
+
+    def start_tool(self, toolname, *args, **popen_args):
+        """Start a tool in the background and return its `Popen` object.
+
+        `popen_args` are passed on to `Popen`, e.g. to redirect output.
+        """
+        binary = self._binaries[toolname]
+        # On Python 3.8+, subprocess uses posix_spawn instead of forking this
+        # process only if the executable has a directory part and close_fds,
+        # cwd, preexec_fn etc. aren't used. Python's own file descriptors
+        # aren't inheritable anyway, so close_fds isn't needed.
+        cmd = [shutil.which(binary) or binary]
+        cmd.extend(args)
+        return subprocess.Popen(cmd, close_fds=False, **popen_args)
+
+    def wait_tool(self, process):
+        """Wait for a process from `start_tool`, like `check_call`.
+
+        If its stderr was captured, it is printed in one piece once the
+        process is done, so it doesn't get mixed up with the output of tools
+        running in parallel.
+        """
+        _, stderr = process.communicate()
+        if stderr:
+            sys.stderr.write(stderr.decode('utf-8', 'replace'))
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode,
+                                                process.args)
+        return process.returncode
+
+    def binary(self, toolname):
+        return self._binaries[toolname]
 
     def run_tool(self, toolname, *args):
-        cmd = [self._tools[toolname]]
-        cmd.extend(args)
-        return subprocess.check_call(cmd)
+        return self.wait_tool(self.start_tool(toolname, *args))
+
+    def sphinx_build(self, *args):
+        # Unless a specific binary was requested, run Sphinx in this process to
+        # save the interpreter startup and imports for every build.
+        if self._binaries['sphinx_build'] == 'sphinx-build':
+            try:
+                from sphinx.cmd.build import build_main
+                from sphinx import locale
+            except ImportError:
+                pass
+            else:
+                # sphinx.locale.init only adds fallbacks to a catalog that is
+                # already loaded, so without this a previous build's language
+                # would win over this one's.
+                locale.translators.clear()
+                ret = build_main(list(args))
+                if ret:
+                    raise subprocess.CalledProcessError(
+                        ret, ['sphinx-build'] + list(args))
+                return ret
+        return self._tools['sphinx_build'](*args)
 
     def __getattr__(self, name):
-        return lambda *args: self.run_tool(name, *args)
+        # look in __dict__ directly, _tools may not be set yet when unpickling
+        try:
+            return self.__dict__['_tools'][name]
+        except KeyError:
+            raise AttributeError(name)
 
     # Let the user specify the path to the tool's binary via CLI argument
     @classmethod
@@ -59,60 +137,269 @@ class Tools:
                                 help='%s command' % tool)
 
 
+def iter_source_files(root, suffixes, skip_prefixes=(), exclude=()):
+    """Find all files in `root` ending in one of `suffixes`.
+
+    Directories whose name starts with one of `skip_prefixes` or whose path
+    is in `exclude` are not entered. Yields `os.DirEntry` objects in the same
+    order as a sorted, top-down `os.walk`.
+    """
+    exclude = set(os.path.abspath(d) for d in exclude)
+    stack = [root]
+    while stack:
+        # os.scandir gets the file types along with the names, so this avoids
+        # the extra stat() per entry that os.walk + os.path.* would need
+        entries = sorted(os.scandir(stack.pop()), key=lambda e: e.name)
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if (not entry.name.startswith(skip_prefixes) and
+                        os.path.abspath(entry.path) not in exclude):
+                    subdirs.append(entry.path)
+            elif entry.name.endswith(suffixes) and entry.is_file():
+                yield entry
+        stack.extend(reversed(subdirs))
+
+
+def hash_tree(root, suffixes, exclude=(), extra=()):
+    """Hash the contents of all files in `root` ending in one of `suffixes`.
+
+    Directories in `exclude`, hidden directories and build directories
+    (``_build*``) are skipped. The strings in `extra` are hashed as well.
+    Returns a hex digest.
+    """
+    h = hashlib.sha256()
+    for s in extra:
+        h.update(s.encode('utf-8') + b'\0')
+    for entry in iter_source_files(root, suffixes, ('.', '_build'), exclude):
+        with open(entry.path, 'rb') as f:
+            data = f.read()
+        h.update(os.path.relpath(entry.path, root).encode('utf-8') + b'\0')
+        h.update(('%d' % len(data)).encode('ascii') + b'\0')
+        h.update(data)
+    return h.hexdigest()
+
+
+def sphinx_fingerprint(binary):
+    """Describe the Sphinx installation used for a build.
+
+    This covers the `binary` as given and as found on the PATH (its size and
+    mtime change when it is reinstalled), and the versions of Sphinx and the
+    themes that this Python can import. Returns a list of strings.
+    """
+    parts = [binary]
+    path = shutil.which(binary)
+    if path:
+        st = os.stat(path)
+        parts.append('%s:%d:%d' % (path, st.st_size, st.st_mtime_ns))
+    for name in SPHINX_PACKAGES:
+        try:
+            module = importlib.import_module(name)
+        except ImportError:
+            version = 'none'
+        else:
+            version = getattr(module, '__version__', 'unknown')
+        parts.append('%s=%s' % (name, version))
+    return parts
+
+
+def read_stamp(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def write_stamp(path, value):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(value)
+
+
+def list_outputs(outdir, builder):
+    """Return the names of the files in `outdir` that `builder` is expected to
+    have produced, as far as later steps rely on them.
+    """
+    suffixes = BUILDER_OUTPUT_SUFFIXES.get(builder)
+    if not suffixes:
+        return []
+    return sorted(entry.name for entry in os.scandir(outdir)
+                  if entry.is_file() and entry.name.endswith(suffixes))
+
+
+def outputs_exist(outdir, outputs):
+    return (os.path.isdir(outdir) and
+            all(os.path.isfile(os.path.join(outdir, name)) for name in outputs))
+
+
+def replace_dir(src, dst):
+    """Move the directory `src` to `dst`, replacing `dst` if it exists.
+
+    If another process installs a new `dst` at the same time, one of the two
+    wins and `src` is removed.
+    """
+    # os.replace can't replace a non-empty directory, so move it aside first
+    trash = tempfile.mkdtemp(prefix='.old-', dir=os.path.dirname(dst))
+    try:
+        try:
+            os.replace(dst, os.path.join(trash, 'old'))
+        except FileNotFoundError:
+            pass
+        try:
+            os.replace(src, dst)
+        except OSError:
+            if not os.path.isdir(dst):
+                raise
+    finally:
+        shutil.rmtree(trash, ignore_errors=True)
+
+
+def default_cache_dir():
+    cache_home = (os.environ.get('XDG_CACHE_HOME') or
+                  os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'speedcrunch-docs')
+
+
 def build_docs(tools, source_dir, build_dir, lang=None, builder='html',
-               tags=[], extra_config={}):
-    config = extra_config.copy()
+               tags=None, extra_config=None, jobs='auto', force=False,
+               cache_dir=None):
+    """Run Sphinx on `source_dir`.
+
+    The build is skipped if neither the sources, the Sphinx arguments nor the
+    Sphinx installation have changed since the last successful build into the
+    same directory and its outputs are still there, unless `force` is set.
+
+    If `cache_dir` is given, the pickled environment is kept there instead of
+    in `build_dir`, so it survives deleting the build directory. Either way,
+    it is only updated if the build succeeds.
+    """
+    config = dict(extra_config or {})
     if lang:
         print('Building docs for %s...' % lang)
         outdir = os.path.join(build_dir, lang)
         config['language'] = lang
     else:
         outdir = build_dir
+    state_name = lang or 'src'
+    # Keep the pickled environment out of the output directory, so it isn't
+    # part of what gets installed or bundled.
+    doctrees_dir = os.path.join(build_dir, '.doctrees-%s' % state_name)
+    if cache_dir:
+        # different source trees and builders can't share an environment
+        source_key = hashlib.sha256(
+            os.path.abspath(source_dir).encode('utf-8')).hexdigest()[:12]
+        cached_doctrees_dir = os.path.join(cache_dir, source_key, builder,
+                                           state_name, 'doctrees')
+        try:
+            os.makedirs(os.path.dirname(cached_doctrees_dir), exist_ok=True)
+        except OSError as e:
+            print('Cannot use cache directory %s (%s), using %s instead.'
+                  % (cache_dir, e, build_dir))
+        else:
+            doctrees_dir = cached_doctrees_dir
     args = [source_dir, outdir, '-b', builder]
-    for k, v in config.items():
-        args.extend(['-D', '%s=%s' % (k, v)])
-    if tags:
-        for tag in tags:
-            args.extend(['-t', tag])
-    return tools.sphinx_build(*args)
+    args.extend('-D%s=%s' % item for item in config.items())
+    for tag in tags or []:
+        args.extend(['-t', tag])
+    # Like the doctrees, this is kept out of the output directory. It stays in
+    # the build directory even with `cache_dir`, as it describes the output:
+    # the source hash, followed by the names of the outputs it was built into.
+    stamp_file = os.path.join(build_dir, '.src-hash-%s' % state_name)
+    src_hash = hash_tree(
+        source_dir, SOURCE_SUFFIXES, exclude=[build_dir],
+        extra=args + sphinx_fingerprint(tools.binary('sphinx_build')))
+    stamp = (read_stamp(stamp_file) or '').splitlines()
+    if (not force and stamp and stamp[0] == src_hash and
+            outputs_exist(outdir, stamp[1:])):
+        print('%s is up to date, skipping.' % outdir)
+        return 0
+    if jobs:
+        args.extend(['-j', str(jobs)])
+    # Build on a private copy of the environment, so a failed or interrupted
+    # build doesn't leave a broken one behind, and concurrent builds sharing a
+    # cache don't write into each other's environment.
+    doctrees_parent = os.path.dirname(doctrees_dir)
+    os.makedirs(doctrees_parent, exist_ok=True)
+    scratch_dir = tempfile.mkdtemp(prefix='.tmp-doctrees-', dir=doctrees_parent)
+    try:
+        new_doctrees_dir = os.path.join(scratch_dir, 'doctrees')
+        if os.path.isdir(doctrees_dir):
+            shutil.copytree(doctrees_dir, new_doctrees_dir)
+        args.extend(['-d', new_doctrees_dir])
+        ret = tools.sphinx_build(*args)
+        replace_dir(new_doctrees_dir, doctrees_dir)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    write_stamp(stamp_file,
+                '\n'.join([src_hash] + list_outputs(outdir, builder)))
+    return ret
 
 
 def generate_qrc(f, files, prefix='/'):
-    f.write('<RCC>\n')
-    f.write('  <qresource prefix="%s">\n' % prefix)
-    for alias, path in files:
-        f.write('    <file alias="%s">%s</file>\n' % (alias, path))
-    f.write('  </qresource>\n')
-    f.write('</RCC>\n')
+    parts = ['<RCC>\n', '  <qresource prefix=%s>\n' % quoteattr(prefix)]
+    parts.extend('    <file alias=%s>%s</file>\n'
+                 % (quoteattr(alias), escape(path))
+                 for alias, path in files)
+    parts.append('  </qresource>\n</RCC>\n')
+    f.write(''.join(parts))
+
 
+# calls of the translation functions recognised by extract_python_strings
+_TRANSLATION_CALL_RE = re.compile(br'\bl?_\s*\(')
 
-def extract_python_strings(dirname, outfile, domain=None):
+
+def find_translatable_files(dirname):
+    """Find the Python files in `dirname` that may contain translations.
+
+    This is a cheap text search, so it can be used to avoid running the
+    extractor on files that can't contain any strings for it.
+    """
+    # skip the same directories as babel's extract_from_dir
+    for entry in iter_source_files(dirname, ('.py',), ('.', '_')):
+        with open(entry.path, 'rb') as f:
+            if _TRANSLATION_CALL_RE.search(f.read()):
+                yield entry.path
+
+
+def extract_python_strings(dirname, outfile, domain=None, force=False):
     """Extract translatable strings from all Python files in `dir`.
 
     Writes a PO template to `outfile`. Recognises `_` and `l_`. Needs babel!
+    Does nothing if `outfile` exists and the Python files haven't changed
+    since it was written, unless `force` is set.
     """
+    stamp_file = outfile + '.inhash'
+    src_hash = hash_tree(dirname, ('.py',), extra=[domain or ''])
+    if (not force and os.path.exists(outfile) and
+            read_stamp(stamp_file) == src_hash):
+        print('%s is up to date, skipping.' % outfile)
+        return
     from babel.messages.catalog import Catalog
-    from babel.messages.extract import extract_from_dir
+    from babel.messages.extract import extract_from_file
     from babel.messages.pofile import write_po
     base_dir = os.path.abspath(os.path.dirname(outfile))
-    msgs = extract_from_dir(dirname, keywords={'_': None, 'l_': None},
-                            comment_tags=['l10n:'])
     cat = Catalog(domain=domain, charset='utf-8')
-    for fname, lineno, message, comments, context in msgs:
-        filepath = os.path.join(dirname, fname)
-        cat.add(message, None, [(os.path.relpath(filepath, base_dir), lineno)],
-                auto_comments=comments, context=context)
+    for filepath in find_translatable_files(dirname):
+        relpath = os.path.relpath(filepath, base_dir)
+        msgs = extract_from_file('python', filepath,
+                                 keywords={'_': None, 'l_': None},
+                                 comment_tags=['l10n:'])
+        for lineno, message, comments, context in msgs:
+            cat.add(message, None, [(relpath, lineno)],
+                    auto_comments=comments, context=context)
     with open(outfile, 'wb') as f:
         write_po(f, cat)
+    write_stamp(stamp_file, src_hash)
 
 
 # commands
 def extract_strings(tools, args):
-    build_docs(tools, args.source_dir, args.build_dir, builder='gettext')
+    build_docs(tools, args.source_dir, args.build_dir, builder='gettext',
+               jobs=args.jobs, force=args.force, cache_dir=args.cache_dir)
     extract_python_strings(
         os.path.join(args.source_dir, 'extensions'),
         os.path.join(args.build_dir, 'extra-doc-strings.pot'),
-        'extra-doc-strings')
+        'extra-doc-strings', force=args.force)
 
 
 def update_translations(tools, args):
@@ -123,29 +410,91 @@ def update_translations(tools, args):
     tools.sphinx_intl(*args)
 
 
+def _jobs_per_language(jobs):
+    # Languages are already built in parallel, so split the processes between
+    # them instead of letting each Sphinx build use all of them.
+    if jobs == 'auto':
+        jobs = multiprocessing.cpu_count()
+    return max(1, jobs // len(LANGUAGES))
+
+
+def _build_languages(worker, args):
+    """Run `worker(args, lang)` for all languages in parallel.
+
+    Returns the worker results in the order of `LANGUAGES`.
+    """
+    with ProcessPoolExecutor(max_workers=len(LANGUAGES)) as executor:
+        return list(executor.map(functools.partial(worker, args), LANGUAGES))
+
+
+# These run in a worker process, so they create their own Tools instance.
+def _build_standalone_lang(args, lang):
+    build_docs(Tools(args), args.source_dir, args.build_dir, lang,
+               jobs=_jobs_per_language(args.jobs), force=args.force,
+               cache_dir=args.cache_dir)
+
+
+def _build_bundled_lang(args, lang):
+    tools = Tools(args)
+    basename = 'manual-%s' % lang
+    build_docs(tools, args.source_dir, args.build_dir, lang,
+               builder='qthelp2', tags=['sc_bundled_docs'],
+               extra_config={'qthelp_basename': basename},
+               jobs=_jobs_per_language(args.jobs), force=args.force,
+               cache_dir=args.cache_dir)
+    # Runs right after this language's Sphinx build, in parallel with the
+    # other languages. Only its errors are shown to keep the output readable.
+    qcg = tools.start_tool('qcollectiongenerator',
+                           os.path.join(args.build_dir, lang,
+                                        '%s.qhcp' % basename),
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    tools.wait_tool(qcg)
+    return [('%s.qch' % basename, '%s/%s.qch' % (lang, basename)),
+            ('%s.qhc' % basename, '%s/%s.qhc' % (lang, basename))]
+
+
 def build_standalone_docs(tools, args):
-    for lang in LANGUAGES:
-        build_docs(tools, args.source_dir, args.build_dir, lang)
+    _build_languages(_build_standalone_lang, args)
 
 
 def build_bundled_docs(tools, args):
     resources = []
-    for lang in LANGUAGES:
-        basename = 'manual-%s' % lang
-        build_docs(tools, args.source_dir, args.build_dir, lang,
-                   builder='qthelp2', tags=['sc_bundled_docs'],
-                   extra_config={'qthelp_basename': basename})
-        tools.qcollectiongenerator(os.path.join(args.build_dir, lang,
-                                                '%s.qhcp' % basename))
-        resources.append(('%s.qch' % basename, '%s/%s.qch' % (lang, basename)))
-        resources.append(('%s.qhc' % basename, '%s/%s.qhc' % (lang, basename)))
+    for lang_resources in _build_languages(_build_bundled_lang, args):
+        resources.extend(lang_resources)
     with open(os.path.join(args.build_dir, 'manual.qrc'), 'w',
               encoding='utf-8') as f:
         print("Creating resource file...")
         generate_qrc(f, resources, prefix='/manual')
 
 
+def build_all(tools, args):
+    # Just runs the two commands in a row; they don't share any build state.
+    extract_args = argparse.Namespace(**vars(args))
+    extract_args.build_dir = args.pot_dir
+    extract_strings(tools, extract_args)
+    build_standalone_docs(tools, args)
+
+
 # CLI
+def jobs_argument(value):
+    return value if value == 'auto' else int(value)
+
+
+def add_build_arguments(parser):
+    parser.add_argument(
+        '--jobs', '-j', default='auto', type=jobs_argument,
+        help='Total number of parallel Sphinx processes, split between the '
+             'languages, or "auto" for one per CPU (default: %(default)s)')
+    parser.add_argument(
+        '--force', '-f', action='store_true',
+        help='Rebuild even if the sources are unchanged')
+    parser.add_argument(
+        '--cache-dir', nargs='?', const=default_cache_dir(),
+        help='Keep the Sphinx environment in this directory instead of the '
+             'build directory, so it survives a clean build (without a value: '
+             '%(const)s)')
+
+
 def build_argument_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -161,6 +510,7 @@ def build_argument_parser():
     parser_extract_strings.add_argument(
         '--build-dir', '-b', default='_build-pot',
         help='Output directory (default: %(default)s')
+    add_build_arguments(parser_extract_strings)
     parser_extract_strings.set_defaults(func=extract_strings)
 
     # update-translations
@@ -180,6 +530,7 @@ def build_argument_parser():
     parser_build_html.add_argument(
         '--build-dir', '-b', default='_build-html',
         help='Output base directory (default: %(default)s')
+    add_build_arguments(parser_build_html)
     parser_build_html.set_defaults(func=build_standalone_docs)
 
     # build-bundled-docs
@@ -189,8 +540,23 @@ def build_argument_parser():
     parser_build_bundled.add_argument(
         '--build-dir', '-b', default='_build-bundled',
         help='Output base directory (default: %(default)s')
+    add_build_arguments(parser_build_bundled)
     parser_build_bundled.set_defaults(func=build_bundled_docs)
 
+    # build-all
+    parser_build_all = subparsers.add_parser(
+        'build-all',
+        help='Extract translatable strings, then build stand-alone HTML docs '
+             'for all languages')
+    parser_build_all.add_argument(
+        '--pot-dir', '-p', default='_build-pot',
+        help='Output directory for POT files (default: %(default)s')
+    parser_build_all.add_argument(
+        '--build-dir', '-b', default='_build-html',
+        help='Output base directory for HTML docs (default: %(default)s')
+    add_build_arguments(parser_build_all)
+    parser_build_all.set_defaults(func=build_all)
+
     return parser
 
 
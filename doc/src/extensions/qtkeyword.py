@@ -26,16 +26,29 @@ qthelp2 builder.
 """
 
 
+import functools
+import itertools
+from xml.sax.saxutils import quoteattr
+
 from docutils.parsers.rst import Directive
 from sphinxcontrib.qthelp import QtHelpBuilder
 from docutils import nodes
 
 
+# indentation of <keyword> elements in the .qhp file
+_INDENT = ' ' * 12
+
+
+@functools.lru_cache(maxsize=None)
+def _target_uri(builder, docname):
+    return builder.get_target_uri(docname)
+
+
 def add_keyword(env, docname, lineno, target, designation, ref_uri):
     if not hasattr(env, 'all_qtkeywords'):
-        env.all_qtkeywords = []
+        env.all_qtkeywords = {}
 
-    env.all_qtkeywords.append({
+    env.all_qtkeywords.setdefault(docname, []).append({
         'docname': docname,
         'lineno': lineno,
         'target': target,
@@ -47,7 +60,7 @@ def add_keyword(env, docname, lineno, target, designation, ref_uri):
 def add_id_keyword(env, id, docname, anchor):
     if not env.config.ignore_qtkeywords:
         add_keyword(env, docname, 0, None, 'id="%s"' % id,
-                    env.app.builder.get_target_uri(docname) + '#' + anchor)
+                    _target_uri(env.app.builder, docname) + '#' + anchor)
 
 
 class QtKeywordDirective(Directive):
@@ -77,7 +90,7 @@ class QtKeywordDirective(Directive):
 
         add_keyword(
             env, env.docname, self.lineno, targetnode, self.arguments,
-            env.app.builder.get_target_uri(env.docname) + '#' + targetid)
+            _target_uri(env.app.builder, env.docname) + '#' + targetid)
         return [targetnode]
 
 
@@ -101,10 +114,7 @@ class MyQtHelpBuilder(QtHelpBuilder):
     def keyword_item(self, name, ref):
         # don't do any id guessing; for regular index entries, we don't generate
         # any id attributes
-        item = ' ' * 12 + '<keyword name="%s" ref="%s"/>' % (name, ref[1])
-        # error checking?
-        item.encode('ascii', 'xmlcharrefreplace')
-        return item
+        return '%s<keyword name="%s" ref="%s"/>' % (_INDENT, name, ref[1])
 
     def build_keywords(self, title, refs, subitems):
         # call parent method for constructing the keywords from index
@@ -116,9 +126,15 @@ class MyQtHelpBuilder(QtHelpBuilder):
                 not hasattr(self.app.env, 'all_qtkeywords') or
                 self.env.config.ignore_qtkeywords):
             return keywords
-        for kw in self.env.all_qtkeywords:
-            keywords.append(' ' * 12 + '<keyword {} ref="{}"/>'
-                            .format(kw["designation"], kw['refuri']))
+        # the designation is copied verbatim, see QtKeywordDirective
+        # Sort by docname: the dict is filled in the order the documents were
+        # read, which varies with parallel and incremental builds.
+        all_keywords = itertools.chain.from_iterable(
+            kws for docname, kws in sorted(self.env.all_qtkeywords.items()))
+        keywords.extend(['%s<keyword %s ref=%s/>'
+                         % (_INDENT, kw['designation'],
+                            quoteattr(kw['refuri']))
+                         for kw in all_keywords])
         self.keywords_completed = True
         return keywords
 
@@ -131,19 +147,51 @@ def purge_keywords(app, env, docname):
     This is necessary to make sure that any keywords that are removed from the
     source don't stay in the persistent environment.
     """
+    _target_uri.cache_clear()
     if not hasattr(env, 'all_qtkeywords'):
         return
 
-    env.all_qtkeywords = [kw for kw in env.all_qtkeywords
-                          if kw['docname'] != docname]
+    env.all_qtkeywords.pop(docname, None)
+
+
+def merge_keywords(app, env, docnames, other):
+    """Merge keywords collected by a parallel reader process."""
+    if not hasattr(other, 'all_qtkeywords'):
+        return
+    if not hasattr(env, 'all_qtkeywords'):
+        env.all_qtkeywords = {}
+
+    for docname in docnames:
+        if docname in other.all_qtkeywords:
+            env.all_qtkeywords[docname] = other.all_qtkeywords[docname]
 
 
-def process_keywords(app, env, docname):
+def process_keywords(app, doctree, docname):
+    """Point the keywords of `docname` at the current builder's URI.
+
+    The environment may have been pickled by a different builder than the one
+    that is writing the output now.
+    """
     if not hasattr(app.env, 'all_qtkeywords'):
         return
-    for kw in app.env.all_qtkeywords:
-        kw['refuri'] = app.builder.get_target_uri(docname)
-        kw['refuri'] += '#' + kw['target']['refid']
+    uri = _target_uri(app.builder, docname)
+    for kw in app.env.all_qtkeywords.get(docname, []):
+        anchor = kw['refuri'].partition('#')[2]
+        kw['refuri'] = uri + '#' + anchor
+
+
+def migrate_keywords(app):
+    """Convert keywords loaded from an old pickled environment.
+
+    Keywords used to be stored in a flat list; now they are kept in a dict
+    mapping each docname to the list of its keywords.
+    """
+    env = app.env
+    if isinstance(getattr(env, 'all_qtkeywords', None), list):
+        keywords = {}
+        for kw in env.all_qtkeywords:
+            keywords.setdefault(kw['docname'], []).append(kw)
+        env.all_qtkeywords = keywords
 
 
 def setup(app):
@@ -151,7 +199,12 @@ def setup(app):
     app.add_config_value('ignore_qtkeywords', True, 'html')
     app.add_builder(MyQtHelpBuilder)
     app.add_directive('qtkeyword', QtKeywordDirective)
+    app.connect('builder-inited', migrate_keywords)
     app.connect('env-purge-doc', purge_keywords)
-    # app.connect('doctree-resolved', process_keywords)
+    app.connect('env-merge-info', merge_keywords)
+    app.connect('doctree-resolved', process_keywords)
 
-    return {'version': '0.1'}   # identifies the version of our extension
+    return {
+        'version': '0.1',   # identifies the version of our extension
+        'parallel_read_safe': True,
+    }
@@ -56,3 +56,7 @@ def _post_config(app, env, *args, **kwargs):
 def setup(app):
     # this event seems fine for our fixup
     app.connect('env-before-read-docs', _post_config)
+    return {
+        'version': '0.1',
+        'parallel_read_safe': True,
+    }
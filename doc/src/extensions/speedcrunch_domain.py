@@ -257,4 +257,7 @@ def add_index_to_standard_domain(app, env, *args):
 def setup(app):
     app.add_domain(SpeedCrunchDomain)
     app.connect('env-before-read-docs', add_index_to_standard_domain)
-    return {'version': '0.1'}
+    return {
+        'version': '0.1',
+        'parallel_read_safe': True,
+    }
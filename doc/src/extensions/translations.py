@@ -56,4 +56,7 @@ def load_translations(app):
 
 def setup(app):
     app.connect('builder-inited', load_translations)
-    return {'version': '0.1'}
+    return {
+        'version': '0.1',
+        'parallel_read_safe': True,
+    }